@@ -1,116 +1,481 @@
+import os
 import json
+import hashlib
+import gzip
+import zlib
+import re
 import sys
 import time
 import random
+import threading
+import http.client
 import xml.etree.ElementTree as ET
 from pathlib import Path
-from urllib.request import urlopen, Request
+from dataclasses import dataclass, asdict
+import base64
+from urllib.parse import urlsplit, urljoin, unquote
+from urllib.request import getproxies, proxy_bypass
 from urllib.error import URLError, HTTPError
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
 import argparse
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # --- Configuration ---
 SITEMAP_FILE = "locations.ampol.com.au-sitemap.xml.xml"
+LOC_TAG = '{http://www.sitemaps.org/schemas/sitemap/0.9}loc'
 DEFAULT_WORKERS = 8
 MAX_RETRIES = 5
 INITIAL_DELAY = 2  # seconds
+MAX_DELAY = 30  # seconds, cap for exponential backoff
+MAX_RETRY_AFTER = 120  # seconds, cap for server-advertised Retry-After
+RETRYABLE_CODES = (429, 502, 503, 504)
+BACKOFFS = tuple(min(MAX_DELAY, INITIAL_DELAY * (1 << i)) for i in range(MAX_RETRIES))  # backoff ceiling per attempt
+MIN_RATE = 0.5  # requests/second floor for the adaptive rate limiter
+RATE_INCREASE = 0.25  # requests/second added after each successful request
+MAX_REDIRECTS = 5
+REQUEST_TIMEOUT = 15  # seconds
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept-Encoding': 'gzip, deflate',
+}
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+PARSER_VERSION = 2  # bump whenever the extraction logic changes to invalidate cached stores
+DAY_ORDER = {'Monday': 0, 'Tuesday': 1, 'Wednesday': 2, 'Thursday': 3, 'Friday': 4, 'Saturday': 5, 'Sunday': 6}
+LOCAL_BUSINESS_TYPE = 'LocalBusiness'
+SERVICE_TYPE = 'Service'
+LOCAL_BUSINESS_MARKER = b'"LocalBusiness"'
+JSONLD_RE = re.compile(rb'<script type="application/ld\+json">(.*?)</script>', re.DOTALL)
 verbose = False
+cache_dir = None
+rate_limiter = None
+parse_pool = None
+head_probe = False
+
+# orjson is optional; its JSONDecodeError subclasses json.JSONDecodeError,
+# so the error handling below works with either decoder.
+json_loads = orjson.loads if orjson else json.loads
+
+# Each worker thread keeps its own keep-alive connection per host so the
+# TCP+TLS handshake is paid once per thread rather than once per store page.
+_local = threading.local()
+
+# Read once, as urlopen's ProxyHandler does, so HTTP(S)_PROXY/NO_PROXY are honoured.
+PROXIES = getproxies()
+
+@dataclass(slots=True)
+class Store:
+    """One extracted store; field order is the key order of the JSON output."""
+    ref: str | None
+    name: str | None
+    url: str | None
+    phone: str | None
+    address: str | None
+    locality: str | None
+    postcode: str | None
+    country: str | None
+    latitude: float | None
+    longitude: float | None
+    openingHours: list
+    services: list
+
+class TokenBucket:
+    """Adaptive token bucket shared by all worker threads.
+
+    The refill rate grows additively on every successful response and is
+    halved on a 429, so workers slow down together instead of each backing
+    off on its own.
+    """
+
+    def __init__(self, rate, capacity, max_rate):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_rate = max_rate
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self._refill()
+            self.rate = min(self.rate + RATE_INCREASE, self.max_rate)
+
+    def on_throttled(self):
+        with self.lock:
+            self._refill()
+            self.rate = max(self.rate * 0.5, MIN_RATE)
+            self.tokens = 0
 
 def extract_urls_from_sitemap(filepath):
-    """Extract store URLs from the sitemap XML file."""
+    """Extract store URLs from the sitemap XML file without building the full tree."""
+    urls = []
     try:
-        tree = ET.parse(filepath)
-        root = tree.getroot()
-        namespace = {'ns': 'http://www.sitemaps.org/schemas/sitemap/0.9'}
-        urls = [
-            elem.text for elem in root.findall('.//ns:loc', namespace)
-            if 'ampol.com.au/en/' in elem.text
-        ]
+        for _, elem in ET.iterparse(filepath, events=('end',)):
+            if elem.tag == LOC_TAG:
+                text = elem.text
+                if text and 'ampol.com.au/en/' in text:
+                    urls.append(text)
+            # Clear every element (not just <loc>) so <url> entries and their
+            # <xhtml:link> children don't accumulate under the root.
+            elem.clear()
         return urls
     except Exception as e:
         print(f"Error parsing sitemap: {e}", file=sys.stderr)
         return []
 
+def _proxy_for(scheme, host):
+    """Return the parsed proxy URL to use for host, or None to connect directly."""
+    proxy = PROXIES.get(scheme)
+    if not proxy or proxy_bypass(host):
+        return None
+    if '://' not in proxy:
+        proxy = 'http://' + proxy
+    return urlsplit(proxy)
+
+def _proxy_auth_headers(proxy):
+    """Return a Proxy-Authorization header for credentials embedded in the proxy URL."""
+    if not proxy.username:
+        return {}
+    credentials = f"{unquote(proxy.username)}:{unquote(proxy.password or '')}"
+    return {'Proxy-Authorization': 'Basic ' + base64.b64encode(credentials.encode()).decode('ascii')}
+
+def _get_connection(scheme, host):
+    """Return this thread's connection to host, opening a new one if needed.
+
+    Plain HTTP goes through a configured proxy with absolute request URLs;
+    HTTPS is tunnelled through it with CONNECT.
+    """
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    conn = connections.get((scheme, host))
+    if conn is None:
+        proxy = _proxy_for(scheme, host)
+        if proxy is None:
+            conn_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+            conn = conn_class(host, timeout=REQUEST_TIMEOUT)
+        elif scheme == 'https':
+            conn = http.client.HTTPSConnection(proxy.netloc.rpartition('@')[2], timeout=REQUEST_TIMEOUT)
+            conn.set_tunnel(host, headers=_proxy_auth_headers(proxy))
+        else:
+            conn = http.client.HTTPConnection(proxy.netloc.rpartition('@')[2], timeout=REQUEST_TIMEOUT)
+        connections[(scheme, host)] = conn
+    return conn
+
+def _drop_connection(scheme, host):
+    """Close and forget this thread's connection to host."""
+    conn = _local.connections.pop((scheme, host), None)
+    if conn is not None:
+        conn.close()
+
+def _decode_body(body, content_encoding):
+    """Undo gzip/deflate content encoding on a response body."""
+    content_encoding = (content_encoding or '').strip().lower()
+    if not body or content_encoding in ('', 'identity'):
+        return body
+    if content_encoding in ('gzip', 'x-gzip'):
+        return gzip.decompress(body)
+    if content_encoding == 'deflate':
+        # Servers disagree on whether "deflate" means zlib-wrapped or raw deflate.
+        try:
+            return zlib.decompress(body)
+        except zlib.error:
+            return zlib.decompress(body, -zlib.MAX_WBITS)
+    raise URLError(f"unsupported Content-Encoding: {content_encoding}")
+
+def fetch(url, extra_headers=None, method='GET'):
+    """Request a URL over a reused connection and return (body bytes, response headers).
+
+    Follows redirects and raises HTTPError/URLError like urlopen does, so
+    callers can keep their existing error handling.
+    """
+    headers = {**HEADERS, **extra_headers} if extra_headers else HEADERS
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        request_headers = headers
+        if parts.scheme == 'http':
+            proxy = _proxy_for(parts.scheme, parts.netloc)
+            if proxy is not None:
+                # Requests sent to an HTTP proxy carry the absolute URL.
+                path = f"http://{parts.netloc}{path}"
+                request_headers = {**headers, **_proxy_auth_headers(proxy)}
+
+        try:
+            conn = _get_connection(parts.scheme, parts.netloc)
+        except http.client.HTTPException as e:  # e.g. InvalidURL for a bad port
+            raise URLError(e)
+        while True:
+            reused = conn.sock is not None
+            try:
+                conn.request(method, path, headers=request_headers)
+                response = conn.getresponse()
+                body = response.read()
+                break
+            except (http.client.HTTPException, OSError) as e:
+                _drop_connection(parts.scheme, parts.netloc)
+                if not reused:
+                    raise URLError(e)
+                # The server closed an idle keep-alive connection; reconnect once.
+                conn = _get_connection(parts.scheme, parts.netloc)
+
+        if response.will_close:
+            _drop_connection(parts.scheme, parts.netloc)
+
+        location = response.getheader('Location')
+        if response.status in REDIRECT_CODES and location:
+            new_url = urljoin(url, location)
+            # Like urlopen, refuse redirects to ftp:, file: and other non-HTTP schemes
+            if urlsplit(new_url).scheme not in ('http', 'https'):
+                raise URLError(f"redirect from {url} to non-HTTP URL {new_url} not allowed")
+            url = new_url
+            continue
+        if not 200 <= response.status < 300:
+            raise HTTPError(url, response.status, response.reason, response.headers, None)
+        return _decode_body(body, response.getheader('Content-Encoding')), response.headers
+
+    raise URLError(f"too many redirects for {url}")
+
+def canonical_url(url):
+    """Drop the query string, fragment and trailing slash so URL variants of one page compare equal."""
+    return url.split('#', 1)[0].split('?', 1)[0].rstrip('/')
+
+def _cache_path(url):
+    """Return the on-disk cache file for a store URL."""
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return cache_dir / key[:2] / f"{key}.json"
+
+def load_cached_store(url):
+    """Return the cache entry for url, or None if missing, unreadable or stale."""
+    if cache_dir is None:
+        return None
+    try:
+        with open(_cache_path(url), encoding='utf-8') as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(entry, dict) or entry.get('version') != PARSER_VERSION:
+        return None
+    try:
+        entry['store'] = Store(**entry['store'])
+    except (TypeError, KeyError):
+        return None
+    return entry
+
+def save_cached_store(url, response_headers, store):
+    """Atomically write a parsed store and its validators to the cache."""
+    etag = response_headers.get('ETag')
+    last_modified = response_headers.get('Last-Modified')
+    if cache_dir is None or not (etag or last_modified):
+        return
+    entry = {'version': PARSER_VERSION, 'etag': etag, 'last_modified': last_modified, 'store': asdict(store)}
+    path = _cache_path(url)
+    tmp_path = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Error writing cache for {url}: {e}", file=sys.stderr)
+
+def retry_delay(headers, attempt):
+    """Seconds to wait before retrying, honouring Retry-After when the server sends one."""
+    retry_after = (headers.get('Retry-After') or '').strip() if headers else ''
+    wait = None
+    if retry_after.isascii() and retry_after.isdigit():
+        # delay-seconds form (RFC 9110 only allows a non-negative integer)
+        wait = int(retry_after)
+    elif retry_after:
+        try:
+            retry_at = parsedate_to_datetime(retry_after)
+        except (TypeError, ValueError):
+            retry_at = None
+        if retry_at is not None:
+            if retry_at.tzinfo is None:
+                retry_at = retry_at.replace(tzinfo=timezone.utc)
+            wait = max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+    if wait is not None:
+        # Don't let a misbehaving server park a worker for hours
+        return min(wait, MAX_RETRY_AFTER) + random.random() * 0.25
+    # Exponential backoff with full jitter
+    return BACKOFFS[attempt] * random.random()
+
+def parse_store_page(html):
+    """Extract store details from the JSON-LD in a store page's HTML bytes.
+
+    Does no I/O and reads no mutable module state, so it can run in a worker process.
+    """
+    store_info, services = None, set()
+    # Pages can carry several JSON-LD blocks (breadcrumbs, organisation, ...);
+    # only decode those that mention LocalBusiness at all.
+    for match in JSONLD_RE.finditer(html):
+        block = match.group(1)
+        if LOCAL_BUSINESS_MARKER not in block: continue
+        raw_data = json_loads(block)
+        
+        if isinstance(raw_data, dict) and '@graph' in raw_data:
+            data_list = raw_data['@graph']
+        elif isinstance(raw_data, list):
+            data_list = raw_data
+        else:
+            data_list = [raw_data]
+
+        for item in data_list:
+            if not isinstance(item, dict): continue
+            item_type = item.get('@type')
+            if item_type == LOCAL_BUSINESS_TYPE: store_info = item
+            elif item_type == SERVICE_TYPE:
+                service_type = item.get('serviceType')
+                if service_type: services.add(service_type)
+        if store_info: break
+        services.clear()
+    
+    if not store_info: return None
+
+    address_info = store_info.get('address', {})
+    street = address_info.get('streetAddress') if isinstance(address_info, dict) else None
+    locality = address_info.get('addressLocality') if isinstance(address_info, dict) else None
+    postcode = address_info.get('postalCode') if isinstance(address_info, dict) else None
+    country_obj = address_info.get('addressCountry') if isinstance(address_info, dict) else {}
+    country = country_obj.get('name') if isinstance(country_obj, dict) else None
+    
+    geo_info = store_info.get('geo', {})
+    latitude = float(geo_info['latitude']) if isinstance(geo_info, dict) and geo_info.get('latitude') else None
+    longitude = float(geo_info['longitude']) if isinstance(geo_info, dict) and geo_info.get('longitude') else None
+    
+    # Bucket hours by day index (unknown days last) to get Monday-Sunday order without sorting
+    day_slots = [[] for _ in range(8)]
+    hours_specs = store_info.get('openingHoursSpecification', [])
+    if not isinstance(hours_specs, list): hours_specs = [hours_specs]
+    for spec in hours_specs:
+        if isinstance(spec, dict):
+            day = spec.get('dayOfWeek', '').split('/')[-1]
+            day_slots[DAY_ORDER.get(day, 7)].append({'dayOfWeek': day, 'opens': spec.get('opens'), 'closes': spec.get('closes')})
+    opening_hours = [hours for slot in day_slots for hours in slot]
+
+    return Store(
+        ref=store_info.get('@id'), name=store_info.get('name'), url=store_info.get('url'),
+        phone=store_info.get('telephone'), address=street, locality=locality, postcode=postcode,
+        country=country, latitude=latitude, longitude=longitude, openingHours=opening_hours,
+        services=sorted(services)
+    )
+
+def cached_store_unchanged(url, cached):
+    """HEAD the page and report whether its ETag still matches the cached one.
+
+    Any failure (including origins that reject HEAD with 405/501) returns
+    False so the caller falls through to a conditional GET.
+    """
+    try:
+        if rate_limiter:
+            rate_limiter.acquire()
+        _, response_headers = fetch(url, method='HEAD')
+    except HTTPError as e:
+        if rate_limiter and e.code == 429:
+            rate_limiter.on_throttled()
+        return False
+    except URLError:
+        return False
+    if rate_limiter:
+        rate_limiter.on_success()
+    return response_headers.get('ETag') == cached['etag']
+
+def parse_html(html):
+    """Parse a page in the process pool if one is enabled, otherwise inline.
+
+    A dead worker breaks the pool for good, so on BrokenProcessPool the pool
+    is abandoned and this and every later page are parsed inline instead.
+    """
+    global parse_pool
+    pool = parse_pool
+    if pool:
+        try:
+            return pool.submit(parse_store_page, html).result()
+        except BrokenProcessPool:
+            if parse_pool is pool:
+                parse_pool = None
+                print("Parse worker pool broke; parsing inline from now on", file=sys.stderr)
+    return parse_store_page(html)
+
 def get_store_details(url):
     """Fetch a store page with retry logic and extract details from JSON-LD."""
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-    req = Request(url, headers=headers)
+    try:
+        cached = load_cached_store(url)
+        conditional_headers = {}
+        if cached:
+            if cached.get('etag'):
+                conditional_headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                conditional_headers['If-Modified-Since'] = cached['last_modified']
+            if head_probe and cached.get('etag') and cached_store_unchanged(url, cached):
+                if verbose:
+                    print(f"ETag unchanged, using cache: {url}", file=sys.stderr)
+                return cached['store']
+    except Exception as e:
+        print(f"An unexpected error occurred for {url}: {e}", file=sys.stderr)
+        return None
     
     for attempt in range(MAX_RETRIES):
         try:
             if attempt > 0 and verbose:
                 print(f"Retrying: {url} (Attempt {attempt + 1}/{MAX_RETRIES})", file=sys.stderr)
             
-            with urlopen(req, timeout=15) as response:
-                html = response.read().decode('utf-8')
-            
-            # --- Start of parsing logic ---
-            start_marker = '<script type="application/ld+json">'
-            end_marker = '</script>'
-            start_idx = html.find(start_marker)
-            
-            if start_idx == -1: return None
-            start_idx += len(start_marker)
-            end_idx = html.find(end_marker, start_idx)
-            if end_idx == -1: return None
-
-            json_str = html[start_idx:end_idx]
-            raw_data = json.loads(json_str)
-            
-            if isinstance(raw_data, dict) and '@graph' in raw_data:
-                data_list = raw_data['@graph']
-            elif isinstance(raw_data, list):
-                data_list = raw_data
-            else:
-                data_list = [raw_data]
-
-            store_info, services = None, []
-            for item in data_list:
-                if not isinstance(item, dict): continue
-                item_type = item.get('@type')
-                if item_type == 'LocalBusiness': store_info = item
-                elif item_type == 'Service' and 'serviceType' in item: services.append(item['serviceType'])
-            
-            if not store_info: return None
-
-            address_info = store_info.get('address', {})
-            street = address_info.get('streetAddress') if isinstance(address_info, dict) else None
-            locality = address_info.get('addressLocality') if isinstance(address_info, dict) else None
-            postcode = address_info.get('postalCode') if isinstance(address_info, dict) else None
-            country_obj = address_info.get('addressCountry') if isinstance(address_info, dict) else {}
-            country = country_obj.get('name') if isinstance(country_obj, dict) else None
-            
-            geo_info = store_info.get('geo', {})
-            latitude = float(geo_info['latitude']) if isinstance(geo_info, dict) and geo_info.get('latitude') else None
-            longitude = float(geo_info['longitude']) if isinstance(geo_info, dict) and geo_info.get('longitude') else None
+            if rate_limiter:
+                rate_limiter.acquire()
+            html, response_headers = fetch(url, conditional_headers)
+            if rate_limiter:
+                rate_limiter.on_success()
             
-            opening_hours = []
-            hours_specs = store_info.get('openingHoursSpecification', [])
-            if not isinstance(hours_specs, list): hours_specs = [hours_specs]
-            for spec in hours_specs:
-                if isinstance(spec, dict):
-                    day = spec.get('dayOfWeek', '').split('/')[-1]
-                    opening_hours.append({'dayOfWeek': day, 'opens': spec.get('opens'), 'closes': spec.get('closes')})
-
-            return {
-                'ref': store_info.get('@id'), 'name': store_info.get('name'), 'url': store_info.get('url'),
-                'phone': store_info.get('telephone'), 'address': street, 'locality': locality, 'postcode': postcode,
-                'country': country, 'latitude': latitude, 'longitude': longitude, 'openingHours': opening_hours,
-                'services': sorted(list(set(services)))
-            }
-            # --- End of parsing logic ---
+            store_data = parse_html(html)
+            if store_data:
+                save_cached_store(url, response_headers, store_data)
+            return store_data
 
         except HTTPError as e:
-            if e.code == 429 and attempt < MAX_RETRIES - 1:
-                # Exponential backoff with jitter
-                delay = (INITIAL_DELAY * 2**attempt) + random.uniform(0, 1)
+            if rate_limiter:
+                if e.code == 429:
+                    rate_limiter.on_throttled()
+                elif e.code == 304:
+                    rate_limiter.on_success()
+            if e.code == 304 and cached:
+                if verbose:
+                    print(f"Not modified, using cache: {url}", file=sys.stderr)
+                return cached['store']
+            if e.code in RETRYABLE_CODES and attempt < MAX_RETRIES - 1:
+                delay = retry_delay(e.headers, attempt)
                 if verbose:
-                    print(f"Rate limited for {url}. Retrying in {delay:.2f}s...", file=sys.stderr)
+                    print(f"HTTP {e.code} for {url}. Retrying in {delay:.2f}s...", file=sys.stderr)
                 time.sleep(delay)
                 continue # Go to next attempt in the loop
             else:
                 print(f"Error fetching {url}: {e}", file=sys.stderr)
-                return None # Non-429 error, or final retry failed
+                return None # Non-retryable error, or final retry failed
         except (URLError, json.JSONDecodeError) as e:
             print(f"Error processing {url}: {e}", file=sys.stderr)
             return None
@@ -120,22 +485,62 @@ def get_store_details(url):
             
     return None # If all retries fail
 
-def sort_opening_hours(store_data):
-    """Sort opening hours from Monday to Sunday."""
-    if store_data and 'openingHours' in store_data and store_data['openingHours']:
-        day_order = {'Monday': 0, 'Tuesday': 1, 'Wednesday': 2, 'Thursday': 3, 'Friday': 4, 'Saturday': 5, 'Sunday': 6}
-        store_data['openingHours'] = sorted(store_data['openingHours'], key=lambda x: day_order.get(x.get('dayOfWeek', ''), 7))
-    return store_data
+def dumps_indented(data):
+    """Encode data as 2-space indented JSON bytes, using orjson when available.
+
+    The output is UTF-8 with non-ASCII characters written as-is rather than
+    \\u-escaped; orjson cannot escape them, so the json fallback is told not
+    to either and both paths produce the same bytes. orjson serialises Store
+    dataclasses natively; json needs asdict as a fallback.
+    """
+    if orjson:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+    return json.dumps(data, indent=2, ensure_ascii=False, default=asdict).encode('utf-8')
+
+def write_json(data):
+    """Write data to stdout as indented JSON."""
+    sys.stdout.flush()
+    sys.stdout.buffer.write(dumps_indented(data) + b"\n")
+    sys.stdout.buffer.flush()
+
+class JsonArrayWriter:
+    """Write a JSON array to stdout one element at a time.
+
+    The output is laid out exactly as json.dumps(items, indent=2) would lay
+    it out, without holding every element in memory.
+    """
+
+    def __init__(self):
+        self.first = True
+        sys.stdout.flush()
+        sys.stdout.buffer.write(b"[")
+
+    def write(self, item):
+        encoded = b"  " + dumps_indented(item).replace(b"\n", b"\n  ")
+        sys.stdout.buffer.write((b"\n" if self.first else b",\n") + encoded)
+        sys.stdout.buffer.flush()
+        self.first = False
+
+    def close(self):
+        sys.stdout.buffer.write(b"]\n" if self.first else b"\n]\n")
+        sys.stdout.buffer.flush()
 
 def main():
     """Main function to scrape all stores and output as JSON."""
-    global verbose
+    global verbose, cache_dir, rate_limiter, parse_pool, head_probe
     
     parser = argparse.ArgumentParser(description='Extract Ampol store details from sitemap.')
     parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose output')
     parser.add_argument('-w', '--workers', type=int, default=DEFAULT_WORKERS, help=f'Number of parallel workers (default: {DEFAULT_WORKERS})')
+    parser.add_argument('-p', '--parse-workers', type=int, default=0, help='Number of processes parsing pages, 0 to parse in the fetch threads (default: 0)')
+    parser.add_argument('--sorted', action='store_true', help='Buffer all stores and output them sorted by ref instead of streaming them as they complete')
+    parser.add_argument('--cache-dir', type=Path, help='Cache parsed stores here and revalidate them with conditional requests')
+    parser.add_argument('--head-probe', action='store_true', help='With --cache-dir, check cached pages with a HEAD request before the conditional GET')
     args = parser.parse_args()
     verbose = args.verbose
+    cache_dir = args.cache_dir
+    head_probe = args.head_probe
+    rate_limiter = TokenBucket(rate=args.workers * 2, capacity=args.workers, max_rate=args.workers * 4)
     
     if not Path(SITEMAP_FILE).exists():
         print(f"Error: Sitemap file '{SITEMAP_FILE}' not found.", file=sys.stderr)
@@ -146,38 +551,59 @@ def main():
         print("Error: No store URLs found in sitemap.", file=sys.stderr)
         sys.exit(1)
 
+    # dict.fromkeys keeps sitemap order, so output and logs stay deterministic
+    unique_urls = list(dict.fromkeys(canonical_url(url) for url in urls))
     if verbose:
         print(f"Found {len(urls)} stores in sitemap", file=sys.stderr)
+        if len(unique_urls) < len(urls):
+            print(f"Skipping {len(urls) - len(unique_urls)} duplicate store URLs", file=sys.stderr)
+    urls = unique_urls
     
     all_stores, errors = [], []
+    extracted = 0
+    output = None if args.sorted else JsonArrayWriter()
+    
+    if args.parse_workers > 0:
+        # spawn rather than fork: the pool is first used from inside fetch threads
+        pool = parse_pool = ProcessPoolExecutor(max_workers=args.parse_workers, mp_context=multiprocessing.get_context('spawn'))
     
     with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        # as_completed rather than executor.map: map yields in input order, so one
+        # page stuck in Retry-After waits would hold back every later store on stdout.
+        # get_store_details catches and reports every Exception itself (cache lookup
+        # included), so future.result() won't raise and truncate streamed output.
         future_to_url = {executor.submit(get_store_details, url): (i, url) for i, url in enumerate(urls, 1)}
         for future in as_completed(future_to_url):
             i, url = future_to_url[future]
-            try:
-                store_data = future.result()
-                if store_data:
-                    store_data = sort_opening_hours(store_data)
-                    all_stores.append(store_data)
-                    if verbose:
-                        print(f"  [{i}/{len(urls)}] OK: {store_data.get('name', 'Unknown')}", file=sys.stderr)
+            store_data = future.result()
+            if store_data:
+                extracted += 1
+                if output:
+                    output.write(store_data)
                 else:
-                    errors.append((i, url))
-                    if verbose:
-                        print(f"  [{i}/{len(urls)}] FAILED to extract: {url}", file=sys.stderr)
-            except Exception as e:
+                    all_stores.append(store_data)
+                if verbose:
+                    print(f"  [{i}/{len(urls)}] OK: {store_data.name or 'Unknown'}", file=sys.stderr)
+            else:
                 errors.append((i, url))
-                print(f"Error processing future for {url}: {e}", file=sys.stderr)
+                if verbose:
+                    print(f"  [{i}/{len(urls)}] FAILED to extract: {url}", file=sys.stderr)
+    
+    if args.parse_workers > 0:
+        pool.shutdown()
+    
+    if output:
+        output.close()
     
-    print(f"\nExtracted {len(all_stores)} stores", file=sys.stderr)
+    print(f"\nExtracted {extracted} stores", file=sys.stderr)
     if errors:
         print(f"Failed to extract {len(errors)} stores:", file=sys.stderr)
         for idx, url in errors:
             print(f"  [{idx}] {url}", file=sys.stderr)
     
-    all_stores_sorted = sorted(all_stores, key=lambda x: x.get('ref', ''))
-    print(json.dumps(all_stores_sorted, indent=2))
+    if args.sorted:
+        all_stores_sorted = sorted(all_stores, key=lambda x: x.ref or '')
+        write_json(all_stores_sorted)
 
 if __name__ == "__main__":
     main()